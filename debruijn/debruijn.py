@@ -13,26 +13,37 @@
 
 """Perform assembly based on debruijn graph."""
 
-from typing import Iterator, Dict, List
+from typing import Iterator, Dict, List, Optional, Tuple, Union
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import matplotlib.pyplot as plt
-import textwrap
-import statistics
 from random import randint
 import argparse
+import gzip
+import io
+import logging
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import sys
 from pathlib import Path
+from itertools import chain, islice
 from networkx import (
     DiGraph,
-    all_simple_paths,
-    lowest_common_ancestor,
-    has_path,
+    condensation,
+    is_directed_acyclic_graph,
+    topological_sort,
     random_layout,
     draw,
+    draw_networkx_edges,
+    draw_networkx_nodes,
     spring_layout,
 )
 import matplotlib
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover
+    njit = None
 from operator import itemgetter
 import random
 import re
@@ -50,6 +61,38 @@ __maintainer__ = "Siann Chalvin"
 __email__ = "siann@chalvin.org"
 __status__ = "Developpement"
 
+logger = logging.getLogger(__name__)
+
+# Nucleotides are encoded as ((c >> 1) ^ (c >> 2)) & 3: A=0, C=1, G=2, T=3.
+# Bits of the offsets of A, C, G and T from "A", to flag the valid bytes c:
+# (_VALID_BASES >> ((c & 0xDF) - 65)) & 1, lower case included
+_VALID_BASES = 1 << 0 | 1 << 2 | 1 << 6 | 1 << 19
+_bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+_complement = str.maketrans("ACGT", "TGCA")
+# Runs of characters that cannot be packed (N, IUPAC codes...)
+_invalid_bases = re.compile("[^ACGT]+")
+# Reverse complement of the 4 bases packed in a byte
+_complemented_bytes = np.arange(256, dtype=np.uint8) ^ np.uint8(255)
+_revcomp_lut = ((_complemented_bytes & 3) << 6 | (_complemented_bytes >> 2 & 3) << 4
+                | (_complemented_bytes >> 4 & 3) << 2 | _complemented_bytes >> 6)
+_IO_BUFFER_SIZE = 1 << 20
+# Number of reads encoded and counted together
+_READ_BATCH_SIZE = 4096
+# Largest kmer that can be packed in a 64 bits integer
+_MAX_PACKED_KMER = 32
+# Memory allowed for the flat 4**k table of uint16 kmer counts (k <= 13)
+_KMER_TABLE_BUDGET = 1 << 27
+_MAX_KMER_COUNT = np.iinfo(np.uint16).max
+# Kmers counted per batch buffered before merging into the running counts
+_MERGE_SIZE = 1 << 22
+
+
+def _jit(function):
+    """Compile function with numba when available, else leave it as is."""
+    if njit is None:
+        return function
+    return njit(cache=True, nogil=True)(function)
+
 
 def isfile(path: str) -> Path:  # pragma: no cover
     """Check if path is an existing file.
@@ -92,62 +135,450 @@ def get_arguments():  # pragma: no cover
         default=Path(os.curdir + os.sep + "contigs.fasta"),
         help="Output contigs in fasta file (default contigs.fasta)",
     )
+    parser.add_argument(
+        "-r",
+        dest="canonical",
+        action="store_true",
+        help="Count canonical kmers, for reads from both strands",
+    )
+    parser.add_argument(
+        "-c",
+        dest="min_count",
+        type=int,
+        default=1,
+        help="Drop kmers seen less than min_count times, 2 removes most "
+        "sequencing errors (default 1)",
+    )
+    parser.add_argument(
+        "-t",
+        dest="n_threads",
+        type=int,
+        default=1,
+        help="Number of kmer counting threads, requires numba (default 1)",
+    )
     parser.add_argument(
         "-f", dest="graphimg_file", type=Path, help="Save graph as an image (png)"
     )
     return parser.parse_args()
 
 
+def _read_fastq_bytes(fastq_file: Path) -> Iterator[bytes]:
+    """Extract reads from (optionally gzipped) fastq files without decoding.
+
+    :param fastq_file: (Path) Path to the fastq file.
+    :return: A generator object that iterate the read sequences (bytes).
+    """
+    if Path(fastq_file).suffix == ".gz":
+        f = io.BufferedReader(gzip.open(fastq_file, "rb"),
+                              buffer_size=_IO_BUFFER_SIZE)
+    else:
+        f = open(fastq_file, "rb", buffering=_IO_BUFFER_SIZE)
+    with f:
+        lines = iter(f.readline, b"")
+        for _ in lines:
+            sequence = next(lines).rstrip()
+            next(lines)
+            next(lines)
+            yield sequence
+
+
+def _read_batches(fastq_file: Path) -> Iterator[bytes]:
+    """Join the reads of a fastq file by batches of _READ_BATCH_SIZE.
+
+    Reads are separated by a newline, which is encoded as an unknown base.
+
+    :param fastq_file: (Path) Path to the fastq file.
+    :return: A generator object that iterate the batches (bytes).
+    """
+    batch = []
+    for sequence in _read_fastq_bytes(fastq_file):
+        batch.append(sequence)
+        if len(batch) == _READ_BATCH_SIZE:
+            yield b"\n".join(batch)
+            batch = []
+    if batch:
+        yield b"\n".join(batch)
+
+
 def read_fastq(fastq_file: Path) -> Iterator[str]:
     """Extract reads from fastq files.
 
     :param fastq_file: (Path) Path to the fastq file.
     :return: A generator object that iterate the read sequences.
     """
-    with open(fastq_file, "r") as f:
-        for line in f:
-            sequence = next(f).strip()
-            next(f)
-            next(f)
-            yield sequence
+    for sequence in _read_fastq_bytes(fastq_file):
+        yield sequence.decode()
 
 
 def cut_kmer(read: str, kmer_size: int) -> Iterator[str]:
     """Cut read into kmers of size kmer_size.
 
+    Every window of the read is returned, i.e. len(read) - kmer_size + 1
+    kmers (the former k_over formula missed the kmers at the read end).
+
     :param read: (str) Sequence of a read.
     :return: A generator object that provides the kmers (str) of size kmer_size.
     """
-    k_over = kmer_size + (len(read) %
-                          kmer_size)  # length of sequence end to remove
-
-    for i in range(0, k_over+1):
+    for i in range(len(read) - kmer_size + 1):
         yield read[i:i+kmer_size]
 
 
-def build_kmer_dict(fastq_file: Path, kmer_size: int) -> Dict[str, int]:
+def _encode_read(read: Union[str, bytes]) -> np.ndarray:
+    """Encode a read into an array of 2-bit nucleotide codes.
+
+    :param read: (str or bytes) Sequence of a read.
+    :return: (np.ndarray) uint8 codes (A=0, C=1, G=2, T=3, other=255).
+    """
+    if isinstance(read, str):
+        read = read.encode()
+    read = np.frombuffer(read, dtype=np.uint8)
+    codes = ((read >> 1) ^ (read >> 2)) & 3
+    offset = (read & 0xDF) - np.uint8(65)
+    valid = (offset < 20) & (np.uint32(_VALID_BASES) >> np.minimum(offset, 19) & 1 == 1)
+    codes[~valid] = 255
+    return codes
+
+
+def cut_kmer_codes(read: Union[str, bytes], kmer_size: int) -> np.ndarray:
+    """Cut read into encoded kmers of size kmer_size, without copying them.
+
+    :param read: (str or bytes) Sequence of a read.
+    :param kmer_size: (int) Size of the kmers.
+    :return: (np.ndarray) A (len(read) - kmer_size + 1, kmer_size) view of
+             the 2-bit nucleotide codes (see _encode_read).
+    """
+    read_codes = _encode_read(read)
+    if read_codes.size < kmer_size:
+        return np.empty((0, kmer_size), dtype=np.uint8)
+    return sliding_window_view(read_codes, kmer_size)
+
+
+def _pack_kmers(kmer_codes: np.ndarray) -> np.ndarray:
+    """Pack each encoded kmer into an integer.
+
+    Kmers overlapping an unknown base (N...) are dropped.
+
+    :param kmer_codes: (np.ndarray) Encoded kmers (see cut_kmer_codes).
+    :return: (np.ndarray) uint64 codes of the valid kmers.
+    """
+    kmer_size = kmer_codes.shape[1]
+    kmer_codes = kmer_codes[(kmer_codes != 255).all(axis=1)]
+    weights = np.uint64(4) ** np.arange(kmer_size - 1, -1, -1, dtype=np.uint64)
+    return kmer_codes.astype(np.uint64) @ weights
+
+
+def _make_kmer_kernels(kmer_size: int, canonical: bool):
+    """Generate the kmer counting kernels of a kmer size (rolling 2-bit code).
+
+    kmer_size, canonical and the masks are closure constants, folded by numba
+    when compiling; the kernels are cached by _kmer_kernels.
+    Reads are uint8 ASCII arrays, any byte other than A, C, G or T (upper or
+    lower case) interrupting the kmers (see _encode_read).
+
+    :param kmer_size: (int) Size of the kmers.
+    :param canonical: (bool) Use min(kmer, reverse complement) codes.
+    :return: (tuple) count_kmers(read, counts), counting the kmers in a flat
+             table of size 4**kmer_size with saturation at its dtype maximum,
+             and roll_kmers(read, kmers) -> n_kmers, writing the uint64 kmer
+             codes in an array at least as long as the read.
+    """
+    mask = (1 << (2 * kmer_size)) - 1
+    shift = 2 * (kmer_size - 1)
+    mask64 = np.uint64(mask)
+    shift64 = np.uint64(shift)
+
+    @_jit
+    def count_kmers(read, counts):
+        max_count = np.iinfo(counts.dtype).max
+        code = 0
+        revcomp = 0
+        valid = 0
+        for char in read:
+            offset = (char & 0xDF) - 65
+            if offset < 0 or offset > 19 or not (_VALID_BASES >> offset) & 1:
+                valid = 0
+                continue
+            base = ((char >> 1) ^ (char >> 2)) & 3
+            code = ((code << 2) | base) & mask
+            valid += 1
+            if canonical:
+                revcomp = (revcomp >> 2) | ((3 - base) << shift)
+            if valid >= kmer_size:
+                key = min(code, revcomp) if canonical else code
+                if counts[key] < max_count:
+                    counts[key] += 1
+
+    @_jit
+    def roll_kmers(read, kmers):
+        code = np.uint64(0)
+        revcomp = np.uint64(0)
+        valid = 0
+        n_kmers = 0
+        for char in read:
+            offset = (char & 0xDF) - 65
+            if offset < 0 or offset > 19 or not (_VALID_BASES >> offset) & 1:
+                valid = 0
+                continue
+            base = ((char >> 1) ^ (char >> 2)) & 3
+            code = ((code << np.uint64(2)) | np.uint64(base)) & mask64
+            valid += 1
+            if canonical:
+                revcomp = (revcomp >> np.uint64(2)) | (np.uint64(3 - base) << shift64)
+            if valid >= kmer_size:
+                kmers[n_kmers] = min(code, revcomp) if canonical else code
+                n_kmers += 1
+        return n_kmers
+
+    return count_kmers, roll_kmers
+
+
+_kmer_kernels_cache = {}
+
+
+def _kmer_kernels(kmer_size: int, canonical: bool):
+    """Get the kmer counting kernels specialized for a kmer size.
+
+    :param kmer_size: (int) Size of the kmers.
+    :param canonical: (bool) Use min(kmer, reverse complement) codes.
+    :return: (tuple) count_kmers and roll_kmers (see _make_kmer_kernels).
+    """
+    if (kmer_size, canonical) not in _kmer_kernels_cache:
+        _kmer_kernels_cache[kmer_size, canonical] = _make_kmer_kernels(
+            kmer_size, canonical)
+    return _kmer_kernels_cache[kmer_size, canonical]
+
+
+def _revcomp_codes(codes: np.ndarray, kmer_size: int) -> np.ndarray:
+    """Reverse complement packed kmers.
+
+    Each byte is complemented and its 4 bases reversed through a lookup
+    table, then the bytes of the 64 bits words are swapped.
+
+    :param codes: (np.ndarray) uint64 codes of the kmers.
+    :param kmer_size: (int) Size of the kmers.
+    :return: (np.ndarray) uint64 codes of the reverse complements.
+    """
+    packed = _revcomp_lut[codes.astype("<u8").view(np.uint8)].view("<u8")
+    return (packed.byteswap() >> np.uint64(64 - 2 * kmer_size)).astype(np.uint64)
+
+
+def _revcomp_kmer(kmer: str) -> str:
+    """Reverse complement a kmer.
+
+    :param kmer: (str) Sequence of the kmer.
+    :return: (str) Its reverse complement.
+    """
+    return kmer.translate(_complement)[::-1]
+
+
+def _count_kmer_codes(fastq_file: Path, kmer_size: int, canonical: bool = False,
+                      n_threads: int = 1, min_count: int = 1):
+    """Count the packed kmers of a fastq file.
+
+    With numba, batches of reads are counted by n_threads threads. When
+    their 4**kmer_size uint16 tables fit in _KMER_TABLE_BUDGET, each thread
+    counts in its own flat table indexed by the kmer codes, the tables being
+    summed at the end, otherwise the codes are sorted and counted with
+    np.unique. Counts saturate at 65535 whenever a single table would fit.
+
+    :param fastq_file: (Path) Path to the fastq file.
+    :param kmer_size: (int) Size of the kmers (at most 32).
+    :param canonical: (bool) Count min(kmer, reverse complement) codes.
+    :param n_threads: (int) Number of counting threads (1 without numba).
+    :param min_count: (int) Drop the kmers seen less than min_count times.
+    :return: (tuple) Sorted uint64 kmer codes and their occurrences.
+    """
+    # Counts saturate whenever a single table fits, whichever path counts them
+    saturate = 4 ** kmer_size * np.dtype(np.uint16).itemsize <= _KMER_TABLE_BUDGET
+    n_tables = max(n_threads, 1)
+    # One uint16 table per thread, plus the uint32 sum of several tables
+    table_size = 4 ** kmer_size * (2 * n_tables + (4 if n_tables > 1 else 0))
+    use_table = njit is not None and table_size <= _KMER_TABLE_BUDGET
+    count_kmers, roll_kmers = _kmer_kernels(kmer_size, canonical)
+    local = threading.local()
+    tables = []
+    kmers = np.empty(0, dtype=np.uint64)
+    counts = np.empty(0, dtype=np.int64)
+    parts = []
+    n_buffered = 0
+
+    def count_batch(batch: bytes):
+        if njit is None:
+            codes = _pack_kmers(cut_kmer_codes(batch, kmer_size))
+            if canonical:
+                codes = np.minimum(codes, _revcomp_codes(codes, kmer_size))
+        elif use_table:
+            if not hasattr(local, "counts"):
+                local.counts = np.zeros(4 ** kmer_size, dtype=np.uint16)
+                tables.append(local.counts)
+            count_kmers(np.frombuffer(batch, dtype=np.uint8), local.counts)
+            return None
+        else:
+            read = np.frombuffer(batch, dtype=np.uint8)
+            codes = np.empty(read.size, dtype=np.uint64)
+            codes = codes[:roll_kmers(read, codes)]
+        return np.unique(codes, return_counts=True)
+
+    def add_counts(part) -> None:
+        # Runs in the calling thread only, merging once the buffered batches
+        # outgrow the running counts so memory follows the distinct kmers
+        nonlocal kmers, counts, n_buffered
+        if part is None:
+            return
+        parts.append(part)
+        n_buffered += part[0].size
+        if n_buffered >= max(_MERGE_SIZE, kmers.size):
+            kmers, counts = _merge_kmer_counts([(kmers, counts)] + parts)
+            parts.clear()
+            n_buffered = 0
+
+    if njit is None or n_threads <= 1:
+        for batch in _read_batches(fastq_file):
+            add_counts(count_batch(batch))
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            pending = set()
+            for batch in _read_batches(fastq_file):
+                if len(pending) >= 2 * n_threads:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add_counts(future.result())
+                pending.add(executor.submit(count_batch, batch))
+            for future in pending:
+                add_counts(future.result())
+
+    if len(tables) == 1:
+        kmers, counts = _table_items(tables[0])
+    elif tables:
+        counts = tables.pop().astype(np.uint32)
+        while tables:
+            counts += tables.pop()
+        np.minimum(counts, _MAX_KMER_COUNT, out=counts)
+        kmers, counts = _table_items(counts)
+        counts = counts.astype(np.uint16)
+    else:
+        kmers, counts = _merge_kmer_counts([(kmers, counts)] + parts)
+        if saturate:
+            # Same saturation as the flat table
+            counts = np.minimum(counts, _MAX_KMER_COUNT).astype(np.uint16)
+    if min_count > 1:
+        kept = counts >= min_count
+        kmers, counts = kmers[kept], counts[kept]
+    return kmers, counts
+
+
+def _merge_kmer_counts(parts):
+    """Merge the counts of several sets of kmers.
+
+    :param parts: (list) Tuples of sorted unique uint64 kmer codes and their
+                  occurrences.
+    :return: (tuple) Sorted uint64 kmer codes and their summed occurrences.
+    """
+    kmers = np.concatenate([part[0] for part in parts])
+    counts = np.concatenate([part[1] for part in parts])
+    if kmers.size == 0:
+        return kmers, counts
+    order = np.argsort(kmers, kind="stable")
+    kmers, counts = kmers[order], counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    return kmers[starts], np.add.reduceat(counts, starts)
+
+
+def _table_items(counts: np.ndarray):
+    """List the kmers present in a flat count table.
+
+    :param counts: (np.ndarray) Occurrences indexed by kmer code.
+    :return: (tuple) Sorted uint64 kmer codes and their occurrences.
+    """
+    kmers = np.flatnonzero(counts)
+    return kmers.astype(np.uint64), counts[kmers]
+
+
+def _decode_kmers(codes: np.ndarray, kmer_size: int) -> List[str]:
+    """Decode packed kmers back to strings.
+
+    :param codes: (np.ndarray) uint64 codes of the kmers.
+    :param kmer_size: (int) Size of the kmers.
+    :return: (list) The kmer sequences.
+    """
+    shifts = np.arange(2 * (kmer_size - 1), -1, -2, dtype=np.uint64)
+    digits = (codes.astype(np.uint64)[:, None] >> shifts) & np.uint64(3)
+    letters = np.ascontiguousarray(_bases[digits]).view(f"S{kmer_size}")
+    return [kmer.decode() for kmer in letters.ravel()]
+
+
+def build_kmer_dict(fastq_file: Path, kmer_size: int, canonical: bool = False,
+                    n_threads: int = 1, min_count: int = 1) -> Dict[str, int]:
     """Build a dictionnary object of all kmer occurrences in the fastq file
 
+    Kmers are counted as packed 2-bit integers and only decoded once counted.
+    Lowercase bases are counted as uppercase ones and kmers holding any other
+    character than ACGT (N...) are skipped.
+
     :param fastq_file: (str) Path to the fastq file.
+    :param canonical: (bool) Count each kmer under the smallest of itself and
+                      its reverse complement (reads from both strands).
+    :param n_threads: (int) Number of counting threads (requires numba).
+    :param min_count: (int) Drop the kmers seen less than min_count times.
     :return: A dictionnary object that identify all kmer occurrences.
     """
-    kmer_dict = {}
-    for seq in read_fastq(fastq_file):
-        kmers = cut_kmer(seq, kmer_size)
-        for kmer in kmers:
-            if kmer in kmer_dict:
-                kmer_dict[kmer] = kmer_dict[kmer]+1
-            else:
-                kmer_dict[kmer] = 1
-    return kmer_dict
+    if kmer_size > _MAX_PACKED_KMER:
+        kmer_dict = {}
+        for seq in read_fastq(fastq_file):
+            # Same case folding and base filter as the packed kmers
+            kmers = chain.from_iterable(
+                cut_kmer(fragment, kmer_size)
+                for fragment in _invalid_bases.split(seq.upper()))
+            for kmer in kmers:
+                if canonical:
+                    kmer = min(kmer, _revcomp_kmer(kmer))
+                if kmer in kmer_dict:
+                    kmer_dict[kmer] = kmer_dict[kmer]+1
+                else:
+                    kmer_dict[kmer] = 1
+        return _drop_rare_kmers(kmer_dict, min_count)
+    kmers, counts = _count_kmer_codes(fastq_file, kmer_size, canonical,
+                                      n_threads, min_count)
+    return dict(zip(_decode_kmers(kmers, kmer_size), counts.tolist()))
+
+
+def _drop_rare_kmers(kmer_dict: Dict[str, int], min_count: int) -> Dict[str, int]:
+    """Drop the kmers seen less than min_count times (mostly sequencing errors)
+
+    :param kmer_dict: A dictionnary object that identify all kmer occurrences.
+    :param min_count: (int) Minimum number of occurrences of the kept kmers.
+    :return: A dictionnary object of the frequent kmer occurrences.
+    """
+    if min_count <= 1:
+        return kmer_dict
+    return {kmer: w for kmer, w in kmer_dict.items() if w >= min_count}
+
+
+def _both_strands(kmer_dict: Dict[str, int]) -> Dict[str, int]:
+    """Add the reverse complement of canonical kmers, with the same count
+
+    :param kmer_dict: A dictionnary object of canonical kmer occurrences.
+    :return: A dictionnary object of the kmer occurrences on both strands.
+    """
+    stranded_dict = dict(kmer_dict)
+    for kmer, w in kmer_dict.items():
+        stranded_dict.setdefault(_revcomp_kmer(kmer), w)
+    return stranded_dict
 
 
-def build_graph(kmer_dict: Dict[str, int]) -> DiGraph:
+def build_graph(kmer_dict: Dict[str, int], canonical: bool = False,
+                min_count: int = 1) -> DiGraph:
     """Build the debruijn graph
 
     :param kmer_dict: A dictionnary object that identify all kmer occurrences.
+    :param canonical: (bool) kmer_dict holds canonical kmers, add the edges
+                      of both strands (bidirected graph).
+    :param min_count: (int) Skip the kmers seen less than min_count times.
     :return: A directed graph (nx) of all kmer substring and weight (occurrence).
     """
+    kmer_dict = _drop_rare_kmers(kmer_dict, min_count)
+    if canonical:
+        kmer_dict = _both_strands(kmer_dict)
     graph = DiGraph()
     for seq, w in kmer_dict.items():
         prefix = seq[:-1]
@@ -157,6 +588,240 @@ def build_graph(kmer_dict: Dict[str, int]) -> DiGraph:
     return graph
 
 
+@_jit
+def _reach_mask(indptr, indices, sources, within, reached, queue):
+    """Flag the nodes reachable from sources (BFS over CSR arrays)
+
+    :param indptr: (np.ndarray) CSR row pointers
+    :param indices: (np.ndarray) CSR successor indices
+    :param sources: (np.ndarray) Indices of the first nodes
+    :param within: (np.ndarray) Boolean mask of the nodes the search may enter
+    :param reached: (np.ndarray) Boolean mask, False for every node on entry,
+                    the reached nodes being flagged (sources included)
+    :param queue: (np.ndarray) int32 buffer of one slot per node, filled
+                  with the reached nodes
+    :return: (int) Number of reached nodes, listed in queue[:n]
+    """
+    tail = 0
+    for source in sources:
+        if not reached[source]:
+            reached[source] = True
+            queue[tail] = source
+            tail += 1
+    head = 0
+    while head < tail:
+        node = queue[head]
+        head += 1
+        for succ in indices[indptr[node]:indptr[node + 1]]:
+            if within[succ] and not reached[succ]:
+                reached[succ] = True
+                queue[tail] = succ
+                tail += 1
+    return tail
+
+
+def _csr_arrays(n_nodes: int, sources: np.ndarray, targets: np.ndarray,
+                weights: np.ndarray):
+    """Sort edge arrays by source node into CSR arrays
+
+    :param n_nodes: (int) Number of nodes
+    :param sources: (np.ndarray) Source node index of each edge
+    :param targets: (np.ndarray) Target node index of each edge
+    :param weights: (np.ndarray) Weight of each edge
+    :return: (tuple) int32 indptr and indices, float32 weights
+    """
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+    return indptr, targets[order].astype(np.int32), weights[order].astype(np.float32)
+
+
+class CSRGraph:
+    """Directed graph stored as CSR adjacency arrays (struct of arrays).
+
+    The successors of node i are indices[indptr[i]:indptr[i + 1]] and the
+    matching edge weights weights[indptr[i]:indptr[i + 1]].
+    When kmer_size is set, node keys are the sorted uint64 array of the
+    2-bit packed codes of the kmer_size - 1 long kmer substrings instead of
+    a list of strings.
+
+    :param node_keys: (list or np.ndarray) Node labels, node i being node_keys[i]
+    :param indptr: (np.ndarray) int32 offsets of the edges of each node
+    :param indices: (np.ndarray) int32 target node of each edge
+    :param weights: (np.ndarray) float32 weight of each edge
+    :param kmer_size: (int) Size of the kmers of packed node keys, else None
+    """
+
+    def __init__(self, node_keys: Union[List[str], np.ndarray], indptr: np.ndarray,
+                 indices: np.ndarray, weights: np.ndarray,
+                 kmer_size: Optional[int] = None) -> None:
+        self.node_keys = node_keys
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.kmer_size = kmer_size
+        # Index of the string keys, built on first use
+        self._index = None
+
+    @classmethod
+    def from_edges(cls, node_keys: Union[List[str], np.ndarray], sources: np.ndarray,
+                   targets: np.ndarray, weights: np.ndarray,
+                   kmer_size: Optional[int] = None) -> "CSRGraph":
+        """Build the graph from edge arrays
+
+        :param node_keys: (list or np.ndarray) Node labels
+        :param sources: (np.ndarray) Source node index of each edge
+        :param targets: (np.ndarray) Target node index of each edge
+        :param weights: (np.ndarray) Weight of each edge
+        :param kmer_size: (int) Size of the kmers of packed node keys, else None
+        :return: (CSRGraph) The graph
+        """
+        return cls(node_keys, *_csr_arrays(len(node_keys), sources, targets, weights),
+                   kmer_size)
+
+    @classmethod
+    def from_kmer_codes(cls, kmers: np.ndarray, counts: np.ndarray,
+                        kmer_size: int, canonical: bool = False) -> "CSRGraph":
+        """Build the debruijn graph on packed kmers, nodes being int codes
+
+        The prefix of kmer code c is c >> 2 and its suffix c & (4**(k-1) - 1).
+
+        :param kmers: (np.ndarray) uint64 codes of the kmers
+        :param counts: (np.ndarray) Occurrences of the kmers
+        :param kmer_size: (int) Size of the kmers
+        :param canonical: (bool) kmers are canonical, add the edges of both
+                          strands (bidirected graph).
+        :return: (CSRGraph) The graph of all kmer substring and weight (occurrence).
+        """
+        kmers = kmers.astype(np.uint64)
+        if canonical:
+            kmers, first = np.unique(
+                np.concatenate((kmers, _revcomp_codes(kmers, kmer_size))),
+                return_index=True)
+            counts = np.concatenate((counts, counts))[first]
+        prefixes = kmers >> np.uint64(2)
+        suffixes = kmers & np.uint64((1 << (2 * (kmer_size - 1))) - 1)
+        # Sort and drop the duplicates in place (cheaper than np.unique)
+        nodes = np.concatenate((prefixes, suffixes))
+        nodes.sort()
+        nodes = np.concatenate((nodes[:1], nodes[1:][nodes[1:] != nodes[:-1]]))
+        return cls.from_edges(nodes, np.searchsorted(nodes, prefixes),
+                              np.searchsorted(nodes, suffixes), counts, kmer_size)
+
+    @classmethod
+    def from_kmer_dict(cls, kmer_dict: Dict[str, int], canonical: bool = False,
+                       min_count: int = 1) -> "CSRGraph":
+        """Build the debruijn graph without going through networkx
+
+        :param kmer_dict: A dictionnary object that identify all kmer occurrences.
+        :param canonical: (bool) kmer_dict holds canonical kmers, add the
+                          edges of both strands (bidirected graph).
+        :param min_count: (int) Skip the kmers seen less than min_count times.
+        :return: (CSRGraph) The graph of all kmer substring and weight (occurrence).
+        """
+        kmer_dict = _drop_rare_kmers(kmer_dict, min_count)
+        if canonical:
+            kmer_dict = _both_strands(kmer_dict)
+        index = {}
+        for kmer in kmer_dict:
+            index.setdefault(kmer[:-1], len(index))
+            index.setdefault(kmer[1:], len(index))
+        n_edges = len(kmer_dict)
+        sources = np.fromiter((index[kmer[:-1]] for kmer in kmer_dict),
+                              dtype=np.int32, count=n_edges)
+        targets = np.fromiter((index[kmer[1:]] for kmer in kmer_dict),
+                              dtype=np.int32, count=n_edges)
+        weights = np.fromiter(kmer_dict.values(), dtype=np.float32, count=n_edges)
+        graph = cls.from_edges(list(index), sources, targets, weights)
+        graph._index = index
+        return graph
+
+    @classmethod
+    def from_digraph(cls, graph: DiGraph) -> "CSRGraph":
+        """Convert a networkx graph, edges without weight weigh 1
+
+        Node keys are packed codes if the graph has a kmer_size attribute.
+
+        :param graph: (nx.DiGraph) A directed graph object
+        :return: (CSRGraph) The same graph
+        """
+        kmer_size = graph.graph.get("kmer_size")
+        node_keys = list(graph.nodes()) if kmer_size is None else sorted(graph.nodes())
+        _, indptr, indices = _csr_adjacency(graph, node_keys)
+        weights = np.fromiter(
+            (graph[u][v].get("weight", 1) for u in node_keys for v in graph.successors(u)),
+            dtype=np.float32, count=indptr[-1])
+        if kmer_size is not None:
+            node_keys = np.array(node_keys, dtype=np.uint64)
+        return cls(node_keys, indptr, indices, weights, kmer_size)
+
+    def to_digraph(self) -> DiGraph:
+        """Convert to a networkx graph (debug and drawing)
+
+        Packed node keys stay int, the graph attribute kmer_size recording
+        how to decode them.
+
+        :return: (nx.DiGraph) A directed graph object
+        """
+        graph = DiGraph()
+        if self.kmer_size is not None:
+            graph.graph["kmer_size"] = self.kmer_size
+        node_keys = (self.node_keys if self.kmer_size is None
+                     else self.node_keys.tolist())
+        graph.add_nodes_from(node_keys)
+        sources = np.repeat(np.arange(len(node_keys)), self.out_degree())
+        graph.add_weighted_edges_from(
+            (node_keys[u], node_keys[v], w)
+            for u, v, w in zip(sources.tolist(), self.indices.tolist(),
+                               self.weights.tolist()))
+        return graph
+
+    def reverse(self):
+        """Reverse the direction of the edges, node indices are unchanged
+
+        :return: (tuple) indptr, indices and weights arrays of the transposed graph
+        """
+        sources = np.repeat(np.arange(len(self.node_keys), dtype=np.int32),
+                            self.out_degree())
+        return _csr_arrays(len(self.node_keys), self.indices, sources, self.weights)
+
+    def node_ids(self, keys: List[str]) -> np.ndarray:
+        """Find the index of nodes of the graph
+
+        Packed keys are searched in the sorted node_keys array, string keys
+        are looked up in a dict.
+
+        :param keys: (list) Node labels
+        :return: (np.ndarray) int64 node indices
+        """
+        if self.kmer_size is not None:
+            return np.searchsorted(self.node_keys, np.array(keys, dtype=np.uint64))
+        if self._index is None:
+            self._index = {key: i for i, key in enumerate(self.node_keys)}
+        return np.fromiter((self._index[key] for key in keys), dtype=np.int64,
+                           count=len(keys))
+
+    def edge_index(self, source: str, target: str) -> int:
+        """Find the position of an edge in the indices and weights arrays
+
+        :param source: (str) Source node of the edge
+        :param target: (str) Target node of the edge
+        :return: (int) The edge index
+        """
+        source_id, target_id = self.node_ids([source, target])
+        start = self.indptr[source_id]
+        row = self.indices[start:self.indptr[source_id + 1]]
+        return int(start + np.flatnonzero(row == target_id)[0])
+
+    def in_degree(self) -> np.ndarray:
+        """Number of predecessors of each node"""
+        return np.bincount(self.indices, minlength=len(self.node_keys))
+
+    def out_degree(self) -> np.ndarray:
+        """Number of successors of each node"""
+        return np.diff(self.indptr)
+
+
 def remove_paths(
     graph: DiGraph,
     path_list: List[List[str]],
@@ -173,17 +838,40 @@ def remove_paths(
     :return: (nx.DiGraph) A directed graph object
     """
     for path in path_list:
-        if (delete_entry_node is True) & (delete_sink_node is True):
-            graph.remove_nodes_from(path)
-        elif delete_entry_node is True:
-            graph.remove_nodes_from(path[:-1])
-        elif delete_sink_node is True:
-            graph.remove_nodes_from(path[1:])
-        else:
-            graph.remove_nodes_from(path[1:-1])
+        graph.remove_nodes_from(_path_nodes(path, delete_entry_node, delete_sink_node))
     return graph
 
 
+def _path_nodes(path: List[str], delete_entry_node: bool, delete_sink_node: bool) -> List[str]:
+    """Nodes of a path removed by remove_paths
+
+    :param path: (list) A path consist of a list of nodes
+    :param delete_entry_node: (boolean) True->We remove the first node of a path
+    :param delete_sink_node: (boolean) True->We remove the last node of a path
+    :return: (list) The nodes to remove
+    """
+    if (delete_entry_node is True) & (delete_sink_node is True):
+        return path
+    if delete_entry_node is True:
+        return path[:-1]
+    if delete_sink_node is True:
+        return path[1:]
+    return path[1:-1]
+
+
+def _argmax(values: List[float]) -> int:
+    """Index of the first maximum of a (short) list
+
+    :param values: (list) A non empty list of numbers
+    :return: (int) Index of the first maximum
+    """
+    best = 0
+    for i in range(1, len(values)):
+        if values[i] > values[best]:
+            best = i
+    return best
+
+
 def select_best_path(
     graph: DiGraph,
     path_list: List[List[str]],
@@ -202,39 +890,127 @@ def select_best_path(
     :param delete_sink_node: (boolean) True->We remove the last node of a path
     :return: (nx.DiGraph) A directed graph object
     """
-    if len(weight_avg_list) > 1:
-        stdev_weight = statistics.stdev(weight_avg_list)
+    if min(weight_avg_list) != max(weight_avg_list):
+        index = _argmax(weight_avg_list)
+    elif min(path_length) != max(path_length):
+        index = _argmax(path_length)
     else:
-        stdev_weight = 0
+        index = randint(0, len(path_list) - 1)
 
-    if len(weight_avg_list) > 1:
-        stdev_length = statistics.stdev(path_length)
-    else:
-        stdev_length = 0
+    # Paths may share nodes with the best one (superbubbles), keep them
+    best_path = set(path_list.pop(index))
+    graph.remove_nodes_from(
+        node for path in path_list
+        for node in _path_nodes(path, delete_entry_node, delete_sink_node)
+        if node not in best_path)
 
-    if stdev_weight != 0:
-        index = np.array(weight_avg_list).argmax()
-    elif stdev_length != 0:
-        index = np.array(path_length).argmax()
-    else:
-        index = randint(0, len(path_list))
+    return graph
 
-    path_list.pop(index)
-    graph = remove_paths(graph, path_list, delete_entry_node, delete_sink_node)
 
-    return graph
+def _csr_adjacency(graph: DiGraph, nodes: List[str]):
+    """Index the successors of nodes as CSR arrays (edges leaving nodes dropped)
 
+    :param graph: (nx.DiGraph) A directed graph object
+    :param nodes: (list) The nodes to index, node i has index i
+    :return: (tuple) Node index dict, indptr and indices int32 arrays
+    """
+    index = {node: i for i, node in enumerate(nodes)}
+    successors = [[index[succ] for succ in graph.successors(node) if succ in index]
+                  for node in nodes]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+    np.cumsum([len(succ) for succ in successors], out=indptr[1:])
+    indices = np.fromiter(chain.from_iterable(successors), dtype=np.int32,
+                          count=indptr[-1])
+    return index, indptr, indices
+
+
+def _path_buffers(n_nodes: int):
+    """Allocate the work arrays of _simple_paths
+
+    :param n_nodes: (int) Number of nodes of the graph
+    :return: (tuple) on_path (all False), path and cursor arrays
+    """
+    return (np.zeros(n_nodes, dtype=np.bool_), np.empty(n_nodes, dtype=np.int32),
+            np.empty(n_nodes, dtype=np.int32))
+
+
+@_jit
+def _simple_paths(indptr, indices, source, target, reachable, on_path, path, cursor):
+    """Enumerate the simple paths from source to target (iterative DFS)
+
+    on_path is False again once the generator is exhausted, so the buffers
+    of _path_buffers can be reused from one search to the next.
+
+    :param indptr: (np.ndarray) CSR row pointers (see _csr_adjacency)
+    :param indices: (np.ndarray) CSR successor indices
+    :param source: (int) Index of the first node
+    :param target: (int) Index of the last node
+    :param reachable: (np.ndarray) False for nodes that cannot reach target
+    :param on_path: (np.ndarray) Boolean buffer, False for every node
+    :param path: (np.ndarray) int32 buffer of one slot per node
+    :param cursor: (np.ndarray) int32 buffer of one slot per node
+    :return: A generator object of int32 arrays of node indices
+    """
+    depth = 0
+    path[0] = source
+    cursor[0] = indptr[source]
+    on_path[source] = True
+    if source == target:
+        yield path[:1].copy()
+        on_path[source] = False
+        depth = -1
+    while depth >= 0:
+        node = path[depth]
+        if cursor[depth] == indptr[node + 1]:
+            on_path[node] = False
+            depth -= 1
+            continue
+        succ = indices[cursor[depth]]
+        cursor[depth] += 1
+        if succ == target:
+            path[depth + 1] = succ
+            yield path[:depth + 2].copy()
+            continue
+        if on_path[succ] or not reachable[succ]:
+            continue
+        depth += 1
+        path[depth] = succ
+        cursor[depth] = indptr[succ]
+        on_path[succ] = True
 
-def path_average_weight(graph: DiGraph, path: List[str]) -> float:
-    """Compute the weight of a path
+
+def _bubble_region(graph: DiGraph, ancestor_node: str, descendant_node: str) -> List[str]:
+    """List the nodes reachable from ancestor_node without going through
+    descendant_node
 
     :param graph: (nx.DiGraph) A directed graph object
+    :param ancestor_node: (str) An upstream node in the graph
+    :param descendant_node: (str) A downstream node in the graph
+    :return: (list) The nodes of the region, ancestor_node first
+    """
+    region = [ancestor_node]
+    seen = {ancestor_node}
+    for node in region:
+        if node == descendant_node:
+            continue
+        for succ in graph.successors(node):
+            if succ not in seen:
+                seen.add(succ)
+                region.append(succ)
+    return region
+
+
+def path_average_weight(graph: Union[DiGraph, CSRGraph], path: List[str]) -> float:
+    """Compute the weight of a path
+
+    :param graph: (nx.DiGraph or CSRGraph) A directed graph object
     :param path: (list) A path consist of a list of nodes
     :return: (float) The average weight of a path
     """
-    return statistics.mean(
-        [d["weight"] for (u, v, d) in graph.subgraph(path).edges(data=True)]
-    )
+    if isinstance(graph, CSRGraph):
+        edges = [graph.edge_index(u, v) for u, v in zip(path, path[1:])]
+        return float(graph.weights[edges].mean())
+    return sum(graph[u][v]["weight"] for u, v in zip(path, path[1:])) / (len(path) - 1)
 
 
 def solve_bubble(graph: DiGraph, ancestor_node: str, descendant_node: str) -> DiGraph:
@@ -245,17 +1021,91 @@ def solve_bubble(graph: DiGraph, ancestor_node: str, descendant_node: str) -> Di
     :param descendant_node: (str) A downstream node in the graph
     :return: (nx.DiGraph) A directed graph object
     """
-    path_list = []
-    len_list = []
-    weight_avg_list = []
-    for path in all_simple_paths(graph, ancestor_node, descendant_node):
-        len_path = len(path)
+    nodes = _bubble_region(graph, ancestor_node, descendant_node)
+    index, indptr, indices = _csr_adjacency(graph, nodes)
+    paths = ([nodes[i] for i in path_ids] for path_ids in _simple_paths(
+        indptr, indices, 0, index[descendant_node], np.ones(len(nodes), dtype=np.bool_),
+        *_path_buffers(len(nodes))))
+    path_list = list(islice(paths, 3))
+    if len(path_list) < 2:
+        return graph
+    weight_avg_list = [path_average_weight(graph, path) for path in path_list]
+    # Only two paths of different weight: the lightest one goes, nodes it
+    # shares with the other one excepted
+    if len(path_list) == 2 and weight_avg_list[0] != weight_avg_list[1]:
+        best = weight_avg_list[1] > weight_avg_list[0]
+        kept = set(path_list[best])
+        graph.remove_nodes_from(
+            node for node in path_list[not best][1:-1] if node not in kept)
+        return graph
+    for path in paths:
         path_list.append(path)
-        len_list.append(len_path)
-        avg_weight = path_average_weight(graph, path)
-        weight_avg_list.append(avg_weight)
-    path = select_best_path(graph, path_list, len_list, weight_avg_list)
-    return path
+        weight_avg_list.append(path_average_weight(graph, path))
+    return select_best_path(graph, path_list, [len(path) for path in path_list],
+                            weight_avg_list)
+
+
+def _topological_order(graph: DiGraph) -> List[str]:
+    """Order the nodes topologically, cycles being collapsed in their SCC
+
+    :param graph: (nx.DiGraph) A directed graph object
+    :return: (list) The nodes of the graph
+    """
+    if is_directed_acyclic_graph(graph):
+        return list(topological_sort(graph))
+    condensed = condensation(graph)
+    return [node for scc in topological_sort(condensed)
+            for node in condensed.nodes[scc]["members"]]
+
+
+def _find_superbubble_exit(
+    succ_map: Dict[str, List[str]], pred_map: Dict[str, List[str]], entrance: str
+) -> Optional[str]:
+    """Find the exit of the superbubble opened by a node (Onodera et al.)
+
+    :param succ_map: (dict) Successors of each node
+    :param pred_map: (dict) Predecessors of each node
+    :param entrance: (str) Candidate entrance of a superbubble
+    :return: (str) The exit node, None if entrance opens no superbubble
+    """
+    stack = [entrance]
+    seen = {entrance}
+    visited = set()
+    while stack:
+        node = stack.pop()
+        visited.add(node)
+        seen.discard(node)
+        if not succ_map[node]:
+            return None
+        for successor in succ_map[node]:
+            if successor == entrance:
+                return None
+            seen.add(successor)
+            if all(pred in visited for pred in pred_map[successor]):
+                stack.append(successor)
+        if len(stack) == 1 and len(seen) == 1:
+            exit_node = stack.pop()
+            if entrance in succ_map[exit_node]:
+                return None
+            return exit_node
+    return None
+
+
+def find_superbubbles(graph: DiGraph) -> List[Tuple[str, str]]:
+    """Find the superbubbles of the graph in a single topological sweep
+
+    :param graph: (nx.DiGraph) A directed graph object
+    :return: (list) (entrance, exit) node pairs in topological order
+    """
+    succ_map = {node: list(succ) for node, succ in graph.succ.items()}
+    pred_map = {node: list(pred) for node, pred in graph.pred.items()}
+    bubbles = []
+    for node in _topological_order(graph):
+        if len(succ_map[node]) > 1:
+            exit_node = _find_superbubble_exit(succ_map, pred_map, node)
+            if exit_node is not None:
+                bubbles.append((node, exit_node))
+    return bubbles
 
 
 def simplify_bubbles(graph: DiGraph) -> DiGraph:
@@ -264,21 +1114,15 @@ def simplify_bubbles(graph: DiGraph) -> DiGraph:
     :param graph: (nx.DiGraph) A directed graph object
     :return: (nx.DiGraph) A directed graph object
     """
-    bubble = False
-    for node in graph.nodes():
-        predecessors = list(graph.predecessors(node))
-        if len(predecessors) > 1:
-            for i in range(0, len(predecessors)):
-                for j in range(i+1, len(predecessors)):
-                    ancestor_node = lowest_common_ancestor(
-                        graph, predecessors[i], predecessors[j])
-                    if ancestor_node is not None:
-                        bubble = True
-                        break
-    if bubble is True:
-        print("simplified")
-        graph = simplify_bubbles(solve_bubble(
-            graph, ancestor_node, node))
+    # Sweep until a pass removes nothing (a pass is enough on a DAG)
+    n_edges = None
+    while n_edges != graph.number_of_edges():
+        n_edges = graph.number_of_edges()
+        # Nested bubbles open after their parent: solve them first
+        for ancestor_node, descendant_node in reversed(find_superbubbles(graph)):
+            if ancestor_node in graph and descendant_node in graph:
+                logger.debug("Solving bubble %s -> %s", ancestor_node, descendant_node)
+                graph = solve_bubble(graph, ancestor_node, descendant_node)
     return graph
 
 
@@ -289,34 +1133,25 @@ def solve_entry_tips(graph: DiGraph, starting_nodes: List[str]) -> DiGraph:
     :param starting_nodes: (list) A list of starting nodes
     :return: (nx.DiGraph) A directed graph object
     """
-    multi_tips = False
-    for node in graph.nodes():
-        predecessors = list(graph.predecessors(node))
-        print(predecessors)
-        tip_predecessors = list(set(predecessors).intersection(starting_nodes))
-        if len(tip_predecessors) > 1:
-            print(1)
-            path_list = []
-            len_list = []
-            weight_avg_list = []
-            paths = [list(all_simple_paths(graph, tip_pred, node))
-                     for tip_pred in tip_predecessors]
-            print(paths)
-            for path in paths:
-                len_path = len(path[0])
-                path_list.append(path[0])
-                len_list.append(len_path)
-                avg_weight = path_average_weight(graph, path[0])
-                weight_avg_list.append(avg_weight)
-            best_path = select_best_path(
-                graph, path_list, len_list, weight_avg_list)
-
-            print(paths)
-            paths.pop(best_path)
-            graph = remove_paths(
-                graph, paths, delete_entry_node=True, delete_sink_node=False)
-            multi_tips = False
-
+    # Follow each starting node down to the first node with several predecessors
+    tips = {}
+    for start in starting_nodes:
+        path = [start]
+        while graph.out_degree(path[-1]) == 1:
+            path.append(next(iter(graph.successors(path[-1]))))
+            if graph.in_degree(path[-1]) > 1:
+                tips.setdefault(path[-1], []).append(path)
+                break
+    for path_list in tips.values():
+        if len(path_list) > 1:
+            graph = select_best_path(
+                graph,
+                path_list,
+                [len(path) for path in path_list],
+                [path_average_weight(graph, path) for path in path_list],
+                delete_entry_node=True,
+                delete_sink_node=False,
+            )
     return graph
 
 
@@ -330,59 +1165,89 @@ def solve_out_tips(graph: DiGraph, ending_nodes: List[str]) -> DiGraph:
     pass
 
 
-def get_starting_nodes(graph: DiGraph) -> List[str]:
+def get_starting_nodes(graph: Union[DiGraph, CSRGraph]) -> List[str]:
     """Get nodes without predecessors
 
-    :param graph: (nx.DiGraph) A directed graph object
+    :param graph: (nx.DiGraph or CSRGraph) A directed graph object
     :return: (list) A list of all nodes without predecessors
     """
-    no_pred = []
-    for node in graph.nodes():
-        if any(True for _ in graph.predecessors(node)):
-            continue
-        else:
-            no_pred.append(node)
-    return no_pred
+    if isinstance(graph, CSRGraph):
+        nodes, in_degree = graph.node_keys, graph.in_degree()
+    else:
+        nodes = list(graph.nodes())
+        in_degree = np.fromiter((d for _, d in graph.in_degree()),
+                                dtype=np.int64, count=len(nodes))
+    if isinstance(nodes, np.ndarray):
+        return nodes[in_degree == 0].tolist()
+    return [nodes[i] for i in np.flatnonzero(in_degree == 0)]
 
 
-def get_sink_nodes(graph: DiGraph) -> List[str]:
+def get_sink_nodes(graph: Union[DiGraph, CSRGraph]) -> List[str]:
     """Get nodes without successors
 
-    :param graph: (nx.DiGraph) A directed graph object
+    :param graph: (nx.DiGraph or CSRGraph) A directed graph object
     :return: (list) A list of all nodes without successors
     """
-    no_succ = []
-    for node in graph.nodes():
-        if any(True for _ in graph.successors(node)):
-            continue
-        else:
-            no_succ.append(node)
-    return no_succ
+    if isinstance(graph, CSRGraph):
+        nodes, out_degree = graph.node_keys, graph.out_degree()
+    else:
+        nodes = list(graph.nodes())
+        out_degree = np.fromiter((d for _, d in graph.out_degree()),
+                                 dtype=np.int64, count=len(nodes))
+    if isinstance(nodes, np.ndarray):
+        return nodes[out_degree == 0].tolist()
+    return [nodes[i] for i in np.flatnonzero(out_degree == 0)]
 
 
 def get_contigs(
-    graph: DiGraph, starting_nodes: List[str], ending_nodes: List[str]
+    graph: Union[DiGraph, CSRGraph], starting_nodes: List[str], ending_nodes: List[str]
 ) -> List:
     """Extract the contigs from the graph
 
-    :param graph: (nx.DiGraph) A directed graph object
+    :param graph: (nx.DiGraph or CSRGraph) A directed graph object
     :param starting_nodes: (list) A list of nodes without predecessors
     :param ending_nodes: (list) A list of nodes without successors
     :return: (list) List of [contiguous sequence and their length]
     """
-    paths = ()
-    contigs = ()
-    for start in starting_nodes:
-        for end in ending_nodes:
-            if has_path(graph, start, end):
-                for path in all_simple_paths(graph, start, end):
-                    paths += (path,)
-    for path in paths:
-        contig = path[0]
-        for i in range(1, len(path)):
-            contig += path[i][-1]
-        contigs += ((contig, len(contig)),)
-    return contigs
+    contigs = []
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_digraph(graph)
+    packed_keys = graph.node_keys if graph.kmer_size is not None else None
+    reverse_indptr, reverse_indices, _ = graph.reverse()
+    n_nodes = len(graph.node_keys)
+    start_ids = graph.node_ids(starting_nodes)
+    end_ids = graph.node_ids(ending_nodes)
+    # Rank of each node in starting_nodes, -1 for the other nodes
+    start_rank = np.full(n_nodes, -1, dtype=np.int64)
+    start_rank[start_ids] = np.arange(start_ids.size)
+    queue = np.empty(n_nodes, dtype=np.int32)
+    # Only the nodes reached from a start can be on a contig
+    from_starts = np.zeros(n_nodes, dtype=np.bool_)
+    _reach_mask(graph.indptr, graph.indices, start_ids,
+                np.ones(n_nodes, dtype=np.bool_), from_starts, queue)
+    # Nodes from which the current end can be reached, one end at a time
+    reachable = np.zeros(n_nodes, dtype=np.bool_)
+    buffers = _path_buffers(n_nodes)
+    for end_rank in np.flatnonzero(from_starts[end_ids]):
+        n_reached = _reach_mask(reverse_indptr, reverse_indices,
+                                end_ids[end_rank:end_rank + 1], from_starts,
+                                reachable, queue)
+        reached = queue[:n_reached]
+        for start in reached[start_rank[reached] >= 0]:
+            for path_ids in _simple_paths(graph.indptr, graph.indices, start,
+                                          end_ids[end_rank], reachable, *buffers):
+                if packed_keys is None:
+                    path = [graph.node_keys[i] for i in path_ids]
+                    contig = path[0] + "".join(node[-1] for node in path[1:])
+                else:
+                    path = packed_keys[path_ids]
+                    contig = (_decode_kmers(path[:1], graph.kmer_size - 1)[0]
+                              + _bases[path[1:] & np.uint64(3)].tobytes().decode())
+                contigs.append((start_rank[start], end_rank, contig))
+        reachable[reached] = False
+    # Group the contigs by starting node (stable sort keeps the path order)
+    contigs.sort(key=lambda item: item[:2])
+    return [(contig, len(contig)) for _, _, contig in contigs]
 
 
 def save_contigs(contigs_list: List[str], output_file: Path) -> None:
@@ -391,11 +1256,12 @@ def save_contigs(contigs_list: List[str], output_file: Path) -> None:
     :param contig_list: (list) List of [contiguous sequence and their length]
     :param output_file: (Path) Path to the output file
     """
-    with open(output_file, mode='w') as f_out:
+    with open(output_file, mode='w', buffering=_IO_BUFFER_SIZE) as f_out:
         contig_n = 0
         for contig in contigs_list:
             f_out.write(f">contig_{contig_n} len={contig[1]}\n")
-            f_out.write(textwrap.fill(contig[0], width=80))
+            f_out.write("\n".join(contig[0][i:i+80]
+                                  for i in range(0, len(contig[0]), 80)))
             f_out.write(f"\n")
             contig_n += 1
 
@@ -415,10 +1281,10 @@ def draw_graph(graph: DiGraph, graphimg_file: Path) -> None:  # pragma: no cover
     # print(elarge)
     # Draw the graph with networkx
     # pos=nx.spring_layout(graph)
-    pos = nx.random_layout(graph)
-    nx.draw_networkx_nodes(graph, pos, node_size=6)
-    nx.draw_networkx_edges(graph, pos, edgelist=elarge, width=6)
-    nx.draw_networkx_edges(
+    pos = random_layout(graph)
+    draw_networkx_nodes(graph, pos, node_size=6)
+    draw_networkx_edges(graph, pos, edgelist=elarge, width=6)
+    draw_networkx_edges(
         graph, pos, edgelist=esmall, width=6, alpha=0.5, edge_color="b", style="dashed"
     )
     # nx.draw_networkx(graph, pos, node_size=10, with_labels=False)
@@ -438,19 +1304,22 @@ def main() -> None:  # pragma: no cover
     file_in = args.fastq_file
     kmer_size = args.kmer_size
     file_out = args.output_file
-    kmer_dict = build_kmer_dict(file_in, kmer_size)
-    graph = build_graph(kmer_dict)
+    if kmer_size <= _MAX_PACKED_KMER:
+        kmers, counts = _count_kmer_codes(file_in, kmer_size, args.canonical,
+                                          args.n_threads, args.min_count)
+        graph = CSRGraph.from_kmer_codes(kmers, counts, kmer_size, args.canonical)
+    else:
+        kmer_dict = build_kmer_dict(file_in, kmer_size, args.canonical,
+                                    args.n_threads, args.min_count)
+        graph = CSRGraph.from_kmer_dict(kmer_dict, args.canonical)
     starting_nodes = get_starting_nodes(graph)
     ending_nodes = get_sink_nodes(graph)
     contigs = get_contigs(graph, starting_nodes, ending_nodes)
     save_contigs(contigs, file_out)
 
-    # Fonctions de dessin du graphe
-    # A decommenter si vous souhaitez visualiser un petit
-    # graphe
-    # Plot the graph
-    # if args.graphimg_file:
-    #     draw_graph(graph, args.graphimg_file)
+    # Plot the graph (networkx is only used for drawing, on small graphs)
+    if args.graphimg_file:
+        draw_graph(graph.to_digraph(), args.graphimg_file)
 
 
 if __name__ == "__main__":  # pragma: no cover
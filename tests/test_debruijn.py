@@ -3,13 +3,16 @@ import pytest
 import os
 import networkx as nx
 import hashlib
+import numpy as np
 from pathlib import Path
 from .test_fixtures import global_data
 from .context import debruijn
 from debruijn import read_fastq
 from debruijn import cut_kmer
+from debruijn import cut_kmer_codes
 from debruijn import build_kmer_dict
 from debruijn import build_graph
+from debruijn import CSRGraph
 from debruijn import get_starting_nodes
 from debruijn import get_sink_nodes
 from debruijn import get_contigs
@@ -19,6 +22,7 @@ from debruijn import remove_paths
 from debruijn import select_best_path
 from debruijn import solve_bubble
 from debruijn import simplify_bubbles
+from debruijn import find_superbubbles
 from debruijn import solve_entry_tips
 from debruijn import solve_out_tips
 
@@ -46,6 +50,15 @@ def test_cut_kmer(global_data):
     global_data.grade += 1
 
 
+def test_cut_kmer_codes():
+    """Test cut_kmer_codes"""
+    kmer_codes = cut_kmer_codes("TCAGA", 3)
+    assert kmer_codes.shape == (3, 3)
+    assert kmer_codes.tolist() == [[3, 1, 0], [1, 0, 2], [0, 2, 0]]
+    assert len(list(cut_kmer("TCAGA", 3))) == 3
+    assert cut_kmer_codes("TC", 3).shape == (0, 3)
+
+
 def test_build_kmer_dict(global_data):
     """Test kmer dict"""
     kmer_dict = build_kmer_dict(Path(__file__).parent / "test_build.fq", 3)
@@ -58,6 +71,27 @@ def test_build_kmer_dict(global_data):
     global_data.grade += 2
 
 
+def test_build_kmer_dict_threads(monkeypatch):
+    """Test kmer dict counted by batches of one read over two threads"""
+    fastq_file = Path(__file__).parent / "test_two_reads.fq"
+    kmer_dict = build_kmer_dict(fastq_file, 5)
+    monkeypatch.setattr(debruijn, "_READ_BATCH_SIZE", 1)
+    assert build_kmer_dict(fastq_file, 5, n_threads=2) == kmer_dict
+    assert build_kmer_dict(fastq_file, 21, n_threads=2) == build_kmer_dict(
+        fastq_file, 21)
+
+
+def test_build_kmer_dict_canonical():
+    """Test canonical kmer dict"""
+    kmer_dict = build_kmer_dict(Path(__file__).parent / "test_build.fq", 3, True)
+    assert kmer_dict == {"TCA": 1, "CAG": 1, "AGA": 2, "CTC": 1}
+    graph = build_graph(kmer_dict, canonical=True)
+    # TCAGAGA and its reverse complement TCTCTGA
+    assert graph.number_of_edges() == 8
+    assert graph.edges["GA", "AG"]["weight"] == 1
+    assert graph.edges["TC", "CT"]["weight"] == 2
+
+
 def test_build_graph(global_data):
     """Test build graph"""
     kmer_dict = {"GAG": 1, "CAG": 1, "AGA": 2, "TCA": 1}
@@ -76,6 +110,43 @@ def test_build_graph(global_data):
     global_data.grade += 4
 
 
+def test_build_graph_min_count():
+    """Test rare kmers removal"""
+    kmer_dict = {"GAG": 1, "CAG": 1, "AGA": 2, "TCA": 1}
+    graph = build_graph(kmer_dict, min_count=2)
+    assert list(graph.edges()) == [("AG", "GA")]
+    assert build_kmer_dict(Path(__file__).parent / "test_build.fq", 3,
+                           min_count=2) == {"AGA": 2}
+
+
+def test_csr_graph():
+    """Test CSR graph"""
+    kmer_dict = {"GAG": 1, "CAG": 1, "AGA": 2, "TCA": 1}
+    graph = CSRGraph.from_kmer_dict(kmer_dict)
+    assert len(graph.node_keys) == 4
+    assert graph.indptr[-1] == 4
+    assert graph.in_degree().tolist() == [1, 2, 1, 0]
+    assert graph.out_degree().tolist() == [1, 1, 1, 1]
+    assert get_starting_nodes(graph) == ["TC"]
+    assert nx.utils.graphs_equal(graph.to_digraph(), build_graph(kmer_dict))
+    assert get_contigs(graph, ["TC"], ["GA"]) == get_contigs(
+        build_graph(kmer_dict), ["TC"], ["GA"])
+
+
+def test_csr_graph_codes():
+    """Test CSR graph on packed kmers"""
+    # TCA, CAG and AGC, A=0 C=1 G=2 T=3
+    kmers = np.array([0b110100, 0b010010, 0b001001], dtype=np.uint64)
+    graph = CSRGraph.from_kmer_codes(kmers, np.array([1, 2, 3]), 3)
+    assert graph.node_keys.dtype == np.uint64
+    assert graph.node_keys.tolist() == [0b0010, 0b0100, 0b1001, 0b1101]
+    assert graph.node_ids([0b1001, 0b0010]).tolist() == [2, 0]
+    assert get_starting_nodes(graph) == [0b1101]
+    assert get_sink_nodes(graph) == [0b1001]
+    assert get_contigs(graph, [0b1101], [0b1001]) == [("TCAGC", 5)]
+    assert get_contigs(graph.to_digraph(), [0b1101], [0b1001]) == [("TCAGC", 5)]
+
+
 def test_get_starting_nodes(global_data):
     graph = nx.DiGraph()
     graph.add_edges_from([(1, 2), (3, 2), (2, 4), (4, 5), (5, 6), (5, 7)])
@@ -139,6 +210,7 @@ def test_path_weight(global_data):
         [(1, 2, 5), (3, 2, 10), (2, 4, 10), (4, 5, 3), (5, 6, 10), (5, 7, 10)]
     )
     assert path_average_weight(graph, [1, 2, 4, 5]) == 6.0
+    assert path_average_weight(CSRGraph.from_digraph(graph), [1, 2, 4, 5]) == 6.0
     global_data.grade += 1
 
 
@@ -226,6 +298,14 @@ def test_select_best_path(global_data):
     global_data.grade += 4
 
 
+def test_select_best_path_random():
+    for _ in range(20):
+        graph = nx.DiGraph()
+        graph.add_edges_from([(1, 2), (2, 4), (4, 5), (2, 8), (8, 5)])
+        graph = select_best_path(graph, [[2, 4, 5], [2, 8, 5]], [3, 3], [1, 1])
+        assert (4 in graph) != (8 in graph)
+
+
 def test_solve_bubble(global_data):
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from(
@@ -283,6 +363,23 @@ def test_solve_bubble(global_data):
     global_data.grade += 2
 
 
+def test_solve_bubble_two_paths():
+    """Two paths of different weight, the lightest one listed first"""
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from(
+        [(1, 2, 1), (2, 3, 1), (3, 5, 1), (1, 4, 5), (4, 5, 5)]
+    )
+    graph = solve_bubble(graph, 1, 5)
+    assert list(graph.edges()) == [(1, 4), (4, 5)]
+    # The lightest path shares node 4 with the heaviest one
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from(
+        [(1, 2, 1), (2, 4, 1), (1, 3, 5), (3, 4, 5), (4, 5, 5), (5, 6, 5)]
+    )
+    graph = solve_bubble(graph, 1, 6)
+    assert sorted(graph.edges()) == [(1, 3), (3, 4), (4, 5), (5, 6)]
+
+
 def test_simplify_bubbles(global_data):
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from(
@@ -308,6 +405,45 @@ def test_simplify_bubbles(global_data):
     global_data.grade += 1
 
 
+def test_simplify_bubbles_chain():
+    """Bubble chains longer than the recursion limit"""
+    graph = nx.DiGraph()
+    for node in range(0, 4500, 3):
+        graph.add_weighted_edges_from(
+            [(node, node + 1, 5), (node, node + 2, 1),
+             (node + 1, node + 3, 5), (node + 2, node + 3, 1)]
+        )
+    graph = simplify_bubbles(graph)
+    assert graph.number_of_edges() == 3000
+    assert 4 in graph
+    assert 5 not in graph
+
+
+def test_simplify_bubbles_shared_nodes():
+    """Superbubble paths sharing nodes with the kept one"""
+    graph = nx.DiGraph()
+    graph.add_weighted_edges_from(
+        [("s", "a", 5), ("s", "b", 1), ("a", "x", 5), ("b", "x", 1),
+         ("a", "y", 1), ("b", "y", 1), ("x", "t", 5), ("y", "t", 1)]
+    )
+    graph = simplify_bubbles(graph)
+    assert list(nx.all_simple_paths(graph, "s", "t")) == [["s", "a", "x", "t"]]
+    assert "b" not in graph
+    assert "y" not in graph
+
+
+def test_find_superbubbles():
+    graph_1 = nx.DiGraph()
+    graph_1.add_edges_from(
+        [(1, 2), (2, 3), (2, 7), (3, 4), (3, 5), (4, 6), (5, 6), (6, 8),
+         (7, 8), (8, 9), (8, 10)]
+    )
+    assert find_superbubbles(graph_1) == [(2, 8), (3, 6)]
+    graph_2 = nx.DiGraph()
+    graph_2.add_edges_from([(1, 2), (2, 3), (2, 4), (3, 5), (4, 5), (5, 2)])
+    assert find_superbubbles(graph_2) == []
+
+
 def test_solve_entry_tips(global_data):
     graph_1 = nx.DiGraph()
     graph_1.add_weighted_edges_from(